@@ -0,0 +1,54 @@
+"""
+Compare the bulk card updates against saving Card instances one by one.
+
+    python -m benchmarks.bulk [number of cards]
+"""
+from datetime import datetime, timedelta
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+from srs_format import api, db
+
+
+def _timed(name, fn):
+    start = time.perf_counter()
+    fn()
+    print(f'{name:<24}{time.perf_counter() - start:8.3f}s')
+
+
+def _bury_each():
+    until = datetime.now() + timedelta(hours=4)
+    with db.database.atomic():
+        for srs_card in db.Card.search('', due='all'):
+            srs_card.bury(until)
+
+
+def _shift_each():
+    with db.database.atomic():
+        for srs_card in db.Card.search('', due='all'):
+            srs_card.next_review += timedelta(days=1)
+            srs_card.save()
+
+
+def main(n=10000):
+    with tempfile.TemporaryDirectory() as tmp:
+        api.init(str(Path(tmp) / 'bench.srs'))
+        model_id = api.create_model('m', ['a'], [{'name': 't', 'front': '{{a}}'}])
+        with db.database.atomic():
+            for i in range(n):
+                api.create_note(model_id, {'a': f'x{i}'})
+
+        print(f'{n} cards')
+        _timed('bury, per card', _bury_each)
+        _timed('bury, bulk', lambda: api.cards_bury(''))
+        _timed('shift_due, per card', _shift_each)
+        _timed('shift_due, bulk', lambda: api.cards_shift_due('', timedelta(days=1)))
+        _timed('reset, bulk', lambda: api.cards_reset(''))
+
+        db.database.close()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,5 +1,5 @@
 import peewee
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from . import db
 from .builder import TemplateBuilder
@@ -10,6 +10,10 @@ def init(filename, create=True, **kwargs):
     db.database.init(filename, **kwargs)
 
     if create:
+        if db.Settings.table_exists():
+            # Older files must gain their new columns before init_tables() indexes them.
+            upgrade()
+
         db.init_tables()
 
     upgrade()
@@ -23,9 +27,9 @@ def find_model(_any=None, id_=None, name=None):
             name = _any
 
     if id_:
-        return db.Model.get_or_none(id=id_).id
+        return db.Model.select(db.Model.id).where(db.Model.id == id_).scalar()
     elif name:
-        return db.Model.get_or_none(name=name).id
+        return db.Model.select(db.Model.id).where(db.Model.name == name).scalar()
     else:
         raise ValueError
 
@@ -54,16 +58,45 @@ def create_model(name, key_fields: list, templates: list):
         return srs_model.id
 
 
-def find_notes(data=None):
+def _iter_rows(query, fields=None):
+    """
+    Stream rows as raw tuples, without building model instances or filling the row cache.
+
+    :param query: a select query of only the projected columns
+    :param fields: if None, the query selects only the id, which is yielded unwrapped
+    :return:
+    """
+    if fields:
+        yield from query.tuples().iterator()
+    else:
+        for id_, in query.tuples().iterator():
+            yield id_
+
+
+def _note_query(data=None, fields=None):
     if data is None:
         data = dict()
 
-    q = db.Note.select()
+    q = db.Note.select(*db.select_fields(db.Note, fields or ['id']))
 
     for k, v in data.items():
         q = q.where(db.Note.data[k] == v)
 
-    return [n.id for n in q]
+    return q
+
+
+def iter_notes(data=None, fields=None):
+    """
+
+    :param dict data:
+    :param list of Union[str, peewee.Field] fields: if None, yield note ids; else yield tuples of these columns
+    :return:
+    """
+    return _iter_rows(_note_query(data, fields), fields)
+
+
+def find_notes(data=None, fields=None):
+    return list(iter_notes(data, fields))
 
 
 def create_note(model_id, data: dict, tags: list=None):
@@ -81,7 +114,7 @@ def create_note(model_id, data: dict, tags: list=None):
 def update_note(note_id, **kwargs):
     srs_note = db.Note.get(id=note_id)
     srs_note.data.update(kwargs)
-    srs_note.modified = datetime.now()
+    srs_note.modified = datetime.utcnow()
     srs_note.save()
 
 
@@ -122,50 +155,176 @@ def cards_remove_deck(card_ids, deck: str):
         srs_card.remove_deck(deck)
 
 
-def find_cards(q_str):
-    return [c.id for c in db.Card.search(q_str)]
+def iter_cards(q_str, fields=None, **kwargs):
+    """
+
+    :param str q_str:
+    :param list of Union[str, peewee.Field] fields: if None, yield card ids; else yield tuples of these columns
+    :param kwargs: passed to `db.Card.search`
+    :return:
+    """
+    return _iter_rows(db.Card.search(q_str, fields=fields or ['id'], **kwargs), fields)
+
+
+def find_cards(q_str, fields=None, **kwargs):
+    return list(iter_cards(q_str, fields, **kwargs))
+
+
+def _cards_update(q_str, values, dry_run=False, chunk_size=500, where=None, **kwargs):
+    """
+    Update every card matching `db.Card.search` with one UPDATE per chunk, without loading Card instances.
+
+    :param str q_str:
+    :param dict values: passed to `db.Card.update`
+    :param bool dry_run: only count the matching cards
+    :param int chunk_size: number of cards updated per transaction
+    :param where: extra condition on the cards to update
+    :param kwargs: passed to `db.Card.search`, where `due` defaults to 'all'
+    :return int: number of cards matched, or updated
+    """
+    kwargs.setdefault('due', 'all')
+    query = db.Card.search(q_str, fields=['id'], **kwargs)
+    if where is not None:
+        query = query.where(where)
+
+    if kwargs.get('limit') or kwargs.get('offset'):
+        # A page of cards is fetched once, as chunking would replace its limit and repeat its offset.
+        card_ids = [card_id for card_id, in query.tuples()]
+        if dry_run:
+            return len(card_ids)
+
+        count = 0
+        for i in range(0, len(card_ids), chunk_size):
+            with db.database.atomic():
+                count += db.Card.update(values).where(db.Card.id.in_(card_ids[i:i + chunk_size])).execute()
+
+        return count
+
+    if dry_run:
+        return db.Card.select().where(db.Card.id.in_(query)).count()
+
+    count = 0
+    last_id = 0
+    while True:
+        # Chunks are walked by id, so that cards no longer matching after an update are not skipped over.
+        card_ids = [card_id for card_id, in query.where(db.Card.id > last_id)
+                    .order_by(db.Card.id).limit(chunk_size).tuples()]
+        if not card_ids:
+            break
+
+        with db.database.atomic():
+            count += db.Card.update(values).where(db.Card.id.in_(card_ids)).execute()
+
+        last_id = card_ids[-1]
+
+    return count
+
+
+def cards_reset(q_str, **kwargs):
+    """
+
+    :param str q_str:
+    :param kwargs: see `_cards_update`
+    :return int:
+    """
+    return _cards_update(q_str, {
+        db.Card.srs_level: None,
+        db.Card.next_review: None
+    }, **kwargs)
+
+
+def cards_bury(q_str, until=timedelta(hours=4), **kwargs):
+    """
+
+    :param str q_str:
+    :param timedelta|datetime until:
+    :param kwargs: see `_cards_update`
+    :return int:
+    """
+    if isinstance(until, timedelta):
+        until = datetime.now() + until
+
+    return _cards_update(q_str, {
+        db.Card.next_review: until
+    }, **kwargs)
+
+
+def cards_shift_due(q_str, delta, spread=None, **kwargs):
+    """
+    Move the next review of cards by `delta`, e.g. after a vacation. Cards not yet reviewed are left as new.
+
+    :param str q_str:
+    :param timedelta delta:
+    :param timedelta spread: if set, cards are randomly spread over [delta, delta + spread), to avoid review pile-ups
+    :param kwargs: see `_cards_update`
+    :return int:
+    """
+    seconds = int(delta.total_seconds())
+    if spread:
+        # peewee's `%` is LIKE, so the modulo is spelled out.
+        seconds = seconds + peewee.fn.abs(peewee.Expression(peewee.fn.random(), '%', int(spread.total_seconds())))
+    else:
+        seconds = peewee.Value(seconds)
+
+    return _cards_update(q_str, {
+        db.Card.next_review: peewee.fn.strftime('%Y-%m-%d %H:%M:%f', db.Card.next_review,
+                                                seconds.concat(' seconds'))
+    }, where=db.Card.next_review.is_null(False), **kwargs)
 
 
 def get_deck_dict(filter_=''):
-    def _node_index(dx, comparison):
-        for i, node in enumerate(dx.setdefault('nodes', list())):
-            if node['text'] == comparison:
-                return i
-
-    def _recurse_name_part(dx, np, deck_info, depth=0):
-        i = _node_index(dx, np[depth])
-
-        if i is not None:
-            di = dx['nodes'][i]
-        else:
-            dx['nodes'].append(dict())
-            di = dx['nodes'][-1]
-            di['text'] = np[depth]
-
-        if depth < len(np) - 1:
-            return _recurse_name_part(di, np, deck_info, depth + 1)
-        else:
-            di['deck'] = deck_info
+    matching_cards = db.Card.search(q_str=filter_, fields=['id'])
+    direct_decks = db.CardDeck.select(db.CardDeck.deck).where(db.CardDeck.card.in_(matching_cards))
+
+    deck_ids = set()
+    for path, in db.Deck.select(db.Deck.path).where(db.Deck.id.in_(direct_decks)).tuples():
+        deck_ids.update(int(i) for i in path.strip('/').split('/'))
 
     d = dict()
-    for srs_deck in db.Deck.select().order_by(db.Deck.name):
-        srs_cards = db.Card.search(q_str=filter_, deck=srs_deck.name)
-        if len(srs_cards) > 0:
-            name_parts = srs_deck.name.split('::')
-            _recurse_name_part(d, name_parts, {
-                'id': srs_deck.id,
-                'name': srs_deck.name
-            })
+    nodes = {None: d}
+    for deck_id, name, parent_id in db.Deck.select(db.Deck.id, db.Deck.name, db.Deck.parent)\
+            .order_by(db.Deck.depth, db.Deck.name).tuples():
+        if deck_id in deck_ids:
+            node = {
+                'text': name.rsplit('::', 1)[-1],
+                'deck': {
+                    'id': deck_id,
+                    'name': name
+                }
+            }
+            nodes.get(parent_id, d).setdefault('nodes', list()).append(node)
+            nodes[deck_id] = node
 
     return d
 
 
 def get_deck_stat(deck_name, filter_=''):
     return {
-        'due': db.Card.search(q_str=filter_, deck=deck_name, due=True).count(),
-        'remaining': db.Card.search(q_str=filter_, deck=deck_name, due=False).count()
+        'due': db.Card.search(q_str=filter_, deck=deck_name, due=True, fields=['id']).count(),
+        'remaining': db.Card.search(q_str=filter_, deck=deck_name, due=False, fields=['id']).count()
     }
 
 
 def has_sub_deck(deck_name):
-    return db.Deck.select().where(db.Deck.name.startswith(deck_name + '::')).count() > 0
+    return db.Deck.select().where(db.Deck.parent.in_(
+        db.Deck.select(db.Deck.id).where(db.Deck.name == deck_name)
+    )).exists()
+
+
+def rename_deck(deck_name, new_name):
+    """
+    Rename, or move, a deck together with all of its sub-decks.
+
+    :param str deck_name:
+    :param str new_name: full name, e.g. 'parent::child'
+    :return:
+    """
+    db.Deck.get(name=deck_name).rename(new_name)
+
+
+def move_deck(deck_name, new_parent_name=None):
+    srs_deck = db.Deck.get(name=deck_name)
+    if new_parent_name:
+        srs_deck.rename(new_parent_name + '::' + srs_deck.base_name)
+    else:
+        srs_deck.rename(srs_deck.base_name)
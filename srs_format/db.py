@@ -29,6 +29,10 @@ class BaseModel(signals.Model):
         database = database
 
 
+def select_fields(model, fields):
+    return [getattr(model, f) if isinstance(f, str) else f for f in fields]
+
+
 class SrsField(pv.TextField):
     def db_value(self, value):
         if value:
@@ -69,7 +73,10 @@ class Tag(BaseModel):
 
 
 class Deck(BaseModel):
-    name = pv.TextField(unique=True, collation='NOCASE')
+    name = pv.TextField(unique=True, collation='NOCASE')   # sub-decks are named 'parent::child'
+    parent = pv.ForeignKeyField('self', null=True, backref='children')
+    path = pv.TextField(null=True, index=True)   # materialised path of ids, e.g. '/1/4/'
+    depth = pv.IntegerField(default=0)
     info = sqlite_ext.JSONField(default=dict)
 
     def __repr__(self):
@@ -78,6 +85,141 @@ class Deck(BaseModel):
     def __str__(self):
         return self.name
 
+    @property
+    def base_name(self):
+        return self.name.rsplit('::', 1)[-1]
+
+    @classmethod
+    def subtree_where(cls, name):
+        """
+        Expression matching the deck called `name`, and all of its sub-decks, as a range scan on `path`.
+
+        :param str name:
+        :return:
+        """
+        path = cls.select(cls.path).where(cls.name == name).scalar()
+        if path is None:
+            return cls.id.is_null(True)
+
+        # Paths are made of digits and '/', so '/1/40' sorts right after every path starting with '/1/4/'.
+        return (cls.path >= path) & (cls.path < path[:-1] + '0')
+
+    def subtree(self):
+        return Deck.select().where(Deck.subtree_where(self.name))
+
+    def has_sub_deck(self):
+        return self.children.exists()
+
+    def rename(self, new_name):
+        """
+        Rename, or move, this deck together with all of its sub-decks, in O(subtree).
+        Assigning `name` and calling save() also goes through here.
+
+        :param str new_name: full name, e.g. 'parent::child'
+        :return:
+        """
+        if new_name.lower().startswith(self.name.lower() + '::'):
+            raise ValueError('Cannot move a deck into its own sub-deck')
+
+        with database.atomic():
+            parent_name = new_name.rpartition('::')[0]
+            if parent_name:
+                parent = Deck.get_or_create(name=parent_name)[0]
+                parent_path = parent.path
+            else:
+                parent = None
+                parent_path = '/'
+
+            old_name, old_path = self.name, self.path
+            new_path = parent_path + f'{self.id}/'
+            depth_delta = new_path.count('/') - old_path.count('/')
+
+            Deck.update(
+                name=pv.Value(new_name).concat(pv.fn.substr(Deck.name, len(old_name) + 1)),
+                path=pv.Value(new_path).concat(pv.fn.substr(Deck.path, len(old_path) + 1)),
+                depth=Deck.depth + depth_delta
+            ).where(Deck.subtree_where(old_name)).execute()
+
+            Deck.update(parent=parent).where(Deck.id == self.id).execute()
+
+            self.name = new_name
+            self.parent = parent
+            self.path = new_path
+            self.depth += depth_delta
+
+
+@signals.pre_save(sender=Deck)
+def deck_pre_save(model_class, instance, created):
+    if created:
+        parent_name = instance.name.rpartition('::')[0]
+        if parent_name:
+            instance.parent = Deck.get_or_create(name=parent_name)[0]
+            instance.depth = instance.parent.depth + 1
+        else:
+            instance.parent = None
+            instance.depth = 0
+    else:
+        # A name assigned before save() moves the deck, so it goes through rename() to keep the tree in order.
+        old_name = Deck.select(Deck.name).where(Deck.id == instance.id).scalar()
+        if old_name is not None and old_name != instance.name:
+            new_name = instance.name
+            instance.name = old_name
+            instance.rename(new_name)
+
+
+@signals.pre_delete(sender=Deck)
+def deck_pre_delete(model_class, instance):
+    # Sub-decks' names start with their parent's, so they must be moved, or deleted, first.
+    if instance.has_sub_deck():
+        raise ValueError(f'Deck {instance.name} has sub-decks')
+
+    CardDeck.delete().where(CardDeck.deck == instance).execute()
+
+
+@signals.post_save(sender=Deck)
+def deck_post_save(model_class, instance, created):
+    if created:
+        parent_path = instance.parent.path if instance.parent_id else '/'
+        instance.path = parent_path + f'{instance.id}/'
+        Deck.update(path=instance.path).where(Deck.id == instance.id).execute()
+
+
+def rebuild_deck_tree():
+    """
+    Recompute `parent`, `path` and `depth` of every deck from its name, creating missing parent decks.
+
+    :return:
+    """
+    with database.atomic():
+        decks = list(Deck.select(Deck.id, Deck.name).tuples())
+        deck_ids = {name.lower(): deck_id for deck_id, name in decks}
+        nodes = dict()
+
+        def _node(name):
+            key = name.lower()
+            if key not in nodes:
+                parent_name = name.rpartition('::')[0]
+                if parent_name:
+                    parent_id, parent_path, parent_depth = _node(parent_name)
+                else:
+                    parent_id, parent_path, parent_depth = None, '/', -1
+
+                deck_id = deck_ids.get(key)
+                if deck_id is None:
+                    deck_id = Deck.insert(name=name).execute()
+
+                nodes[key] = (deck_id, parent_path + f'{deck_id}/', parent_depth + 1)
+                Deck.update(
+                    parent=parent_id,
+                    path=nodes[key][1],
+                    depth=nodes[key][2]
+                ).where(Deck.id == deck_id).execute()
+
+            return nodes[key]
+
+        for _, deck_name in decks:
+            _node(deck_name)
+
 
 class Media(BaseModel):
     data = pv.BlobField()
@@ -130,8 +272,8 @@ class Note(BaseModel):
     constraint = ConstraintField(unique=True)  # format = list()
     _tags = pv.ManyToManyField(Tag, backref='notes')
 
-    created = pv.DateTimeField(constraints=[pv.SQL('DEFAULT CURRENT_TIMESTAMP')])
-    modified = pv.DateTimeField(constraints=[pv.SQL('DEFAULT CURRENT_TIMESTAMP')])
+    created = pv.DateTimeField(constraints=[pv.SQL('DEFAULT CURRENT_TIMESTAMP')])    # UTC
+    modified = pv.DateTimeField(constraints=[pv.SQL('DEFAULT CURRENT_TIMESTAMP')])   # UTC
 
     info = sqlite_ext.JSONField(default=dict)
 
@@ -166,7 +308,7 @@ def note_pre_save(model_class, instance, created):
         d[k] = instance.data[k]
     instance.constraint = d
 
-    instance.modified = datetime.now()
+    instance.modified = datetime.utcnow()
 
 
 @signals.post_save(sender=Note)
@@ -193,7 +335,7 @@ class Card(BaseModel):
     next_review = pv.DateTimeField(null=True)
     _decks = pv.ManyToManyField(Deck, backref='cards')
 
-    last_review = pv.DateTimeField(constraints=[pv.SQL('DEFAULT CURRENT_TIMESTAMP')])
+    last_review = pv.DateTimeField(constraints=[pv.SQL('DEFAULT CURRENT_TIMESTAMP')])    # UTC
     info = sqlite_ext.JSONField(default=dict)
 
     backup = None
@@ -274,6 +416,7 @@ class Card(BaseModel):
         self.info['lapse'] = 0
         self.info['streak'] = self.info.get('streak', 0) + 1
         self.info['total_right'] = self.info.get('total_right', 0) + 1
+        self.last_review = datetime.utcnow()
 
         self.save()
 
@@ -299,6 +442,7 @@ class Card(BaseModel):
         self.info['streak'] = 0
         self.info['lapse'] = self.info.get('lapse', 0) + 1
         self.info['total_wrong'] = self.info.get('total_wrong', 0) + 1
+        self.last_review = datetime.utcnow()
 
         self.bury(next_review)
 
@@ -336,18 +480,23 @@ class Card(BaseModel):
         return cls.iter_quiz(due=True, **kwargs)
 
     @classmethod
-    def search(cls, q_str='', deck=None, tags=None, due=None, offset=0, limit=None):
+    def search(cls, q_str='', deck=None, tags=None, due=None, offset=0, limit=None, fields=None):
         """
 
         :param q_str:
         :param deck:
         :param tags:
-        :param bool|None|timedelta|datetime due:
+        :param bool|None|timedelta|datetime|str due: 'all' to include cards that are not yet due
         :param offset:
         :param limit:
+        :param list of Union[str, pv.Field] fields: select only these columns, e.g. ['id'];
+            combine with `.tuples().iterator()` to stream rows without building Card instances
         :return:
         """
-        query = cls.select()
+        if fields:
+            query = cls.select(*select_fields(cls, fields))
+        else:
+            query = cls.select()
         due_is_set = False
         note_keys = None
 
@@ -383,9 +532,10 @@ class Card(BaseModel):
 
                             query = query.switch(cls).where(cls.next_review < _due)
                     elif seg[0] == 'deck':
-                        deck_q = (Deck.name == seg[2])
-                        if seg[1] != '=':
-                            deck_q = (deck_q | Deck.name.startswith(seg[2] + '::'))
+                        if seg[1] == '=':
+                            deck_q = (Deck.name == seg[2])
+                        else:
+                            deck_q = Deck.subtree_where(seg[2])
 
                         query = query.switch(cls).join(CardDeck).join(Deck).where(deck_q)
                     elif seg[0] == 'tag':
@@ -413,13 +563,14 @@ class Card(BaseModel):
             query = query.switch(cls).where(cls.next_review < datetime.now() + due)
         elif isinstance(due, datetime):
             query = query.switch(cls).where(cls.next_review < due)
+        elif due == 'all':
+            pass
         else:
             if not due_is_set:
                 query = query.where((cls.next_review < datetime.now()) | cls.next_review.is_null(True))
 
         if deck:
-            query = query.switch(cls).join(CardDeck).join(Deck).where(Deck.name.startswith(deck + '::')
-                                                                      | (Deck.name == deck))
+            query = query.switch(cls).join(CardDeck).join(Deck).where(Deck.subtree_where(deck))
 
         if tags:
             for tag in tags:
@@ -444,9 +595,112 @@ def card_pre_save(model_class, instance, created):
     instance.modified = datetime.now()
 
 
+class Change(BaseModel):
+    """
+    Change-feed, kept up to date by SQLite triggers. `id` is the change sequence, and only the latest change
+    of each row is kept. Rows are identified by natural keys, e.g. deck name, so that they match across files.
+    """
+    id = sqlite_ext.AutoIncrementField()
+    tbl = pv.TextField()
+    key = pv.TextField()                   # JSON array
+    row_id = pv.IntegerField(null=True)    # None, if deleted; else the row, which may have been renamed
+    op = pv.TextField()                    # 'upsert' or 'delete'
+    at = pv.DateTimeField()
+    origin = pv.TextField(null=True)       # peer the change was applied from, None if made locally
+
+    class Meta:
+        indexes = [
+            (('tbl', 'key'), True),
+            (('tbl', 'row_id'), False),
+        ]
+
+
+class ChangeOrigin(BaseModel):
+    """
+    Holds the name of the peer whose changes are being applied, for the triggers to copy into `Change.origin`.
+    It is only filled inside the transaction of `sync.apply_changes`.
+    """
+    peer = pv.TextField()
+
+
+# name in the change-feed: (model, natural key of row X as SQL, [(child model, foreign key column)])
+# Children are touched when the key of a row changes, so that their keys are re-recorded.
+CHANGE_TRACKED = {
+    'model': (Model, 'json_array(X.name)', [(Template, 'model_id'), (Note, 'model_id')]),
+    'template': (Template, 'json_array((SELECT name FROM model WHERE id = X.model_id), X.name)',
+                 [(Card, 'template_id')]),
+    'tag': (Tag, 'json_array(X.name)', [(NoteTag, 'tag_id')]),
+    'deck': (Deck, 'json_array(X.name)', [(CardDeck, 'deck_id')]),
+    'media': (Media, 'json_array(X.h)', []),
+    'note': (Note, 'json_array(json(X."constraint"))', [(NoteTag, 'note_id'), (Card, 'note_id')]),
+    'card': (Card, 'json_array(X._front)', [(CardDeck, 'card_id')]),
+    'note_tag': (NoteTag, 'json_array(json((SELECT "constraint" FROM note WHERE id = X.note_id)), '
+                          '(SELECT name FROM tag WHERE id = X.tag_id))', []),
+    'card_deck': (CardDeck, 'json_array((SELECT _front FROM card WHERE id = X.card_id), '
+                            '(SELECT name FROM deck WHERE id = X.deck_id))', []),
+}
+
+_CHANGE_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"   # UTC, like `Note.modified` and `Card.last_review`
+_CHANGE_ORIGIN = '(SELECT peer FROM changeorigin LIMIT 1)'
+_CHANGE_INSERT = 'INSERT OR REPLACE INTO change (tbl, "key", row_id, op, at, origin) '
+# Keys of the children may change without a change of their own, e.g. a deck membership, after the deck is renamed.
+_CHANGE_DELETE_UPSERT = "DELETE FROM change WHERE tbl = '{name}' AND row_id = NEW.id AND op = 'upsert'; "
+
+
+def create_change_triggers():
+    for name, (model, key, children) in CHANGE_TRACKED.items():
+        table = model._meta.table_name
+        old_key = key.replace('X.', 'OLD.')
+        new_key = key.replace('X.', 'NEW.')
+
+        touch_children = ''.join(
+            f'UPDATE "{child._meta.table_name}" SET {column} = {column} '
+            f'WHERE {column} = NEW.id AND {old_key} IS NOT {new_key}; '
+            for child, column in children
+        )
+
+        database.execute_sql(
+            f'CREATE TRIGGER IF NOT EXISTS change_{name}_insert AFTER INSERT ON "{table}" BEGIN '
+            f"{_CHANGE_INSERT} VALUES ('{name}', {new_key}, NEW.id, 'upsert', {_CHANGE_NOW}, {_CHANGE_ORIGIN}); "
+            f'END'
+        )
+        # A changed key is recorded as a delete that keeps the row id, so that peers can rename their row.
+        database.execute_sql(
+            f'CREATE TRIGGER IF NOT EXISTS change_{name}_update AFTER UPDATE ON "{table}" BEGIN '
+            f"{_CHANGE_INSERT} SELECT '{name}', {old_key}, NEW.id, 'delete', {_CHANGE_NOW}, {_CHANGE_ORIGIN} "
+            f'WHERE {old_key} IS NOT {new_key}; '
+            # A touched child gets a new key without a delete of its old one, so older upserts of the row go.
+            f"DELETE FROM change WHERE tbl = '{name}' AND row_id = NEW.id AND op = 'upsert'; "
+            f"{_CHANGE_INSERT} VALUES ('{name}', {new_key}, NEW.id, 'upsert', {_CHANGE_NOW}, {_CHANGE_ORIGIN}); "
+            f'{touch_children}'
+            f'END'
+        )
+        database.execute_sql(
+            f'CREATE TRIGGER IF NOT EXISTS change_{name}_delete AFTER DELETE ON "{table}" BEGIN '
+            f"{_CHANGE_INSERT} VALUES ('{name}', {old_key}, NULL, 'delete', {_CHANGE_NOW}, {_CHANGE_ORIGIN}); "
+            f'END'
+        )
+
+
+def seed_changes():
+    """
+    Record every existing row as changed, so that a file created before the change-feed can be synced from 0.
+
+    :return:
+    """
+    with database.atomic():
+        for name, (model, key, _) in CHANGE_TRACKED.items():
+            database.execute_sql(
+                f"{_CHANGE_INSERT} SELECT '{name}', {key}, X.id, 'upsert', {_CHANGE_NOW}, NULL "
+                f'FROM "{model._meta.table_name}" AS X'
+            )
+
+
 def init_tables():
     database.create_tables([Settings,
                             Tag, Note, NoteTag,
                             Deck, Card, CardDeck,
-                            Media, Model, Template])
+                            Media, Model, Template,
+                            Change, ChangeOrigin])
+    create_change_triggers()
     Settings.get_or_create()
@@ -33,3 +33,21 @@ def upgrade():
         )
         settings.info['version'] = '0.2.1'
         settings.save()
+
+    if version < '0.2.2':
+        migrate(
+            migrator.add_column('deck', 'parent_id', pv.IntegerField(null=True, index=True)),
+            migrator.add_column('deck', 'path', pv.TextField(null=True, index=True)),
+            migrator.add_column('deck', 'depth', pv.IntegerField(default=0))
+        )
+        db.rebuild_deck_tree()
+        settings.info['version'] = '0.2.2'
+        settings.save()
+
+    if version < '0.2.3':
+        db.Change.create_table()
+        db.ChangeOrigin.create_table()
+        db.create_change_triggers()
+        db.seed_changes()
+        settings.info['version'] = '0.2.3'
+        settings.save()
@@ -0,0 +1,274 @@
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+import threading
+import logging
+import pickle
+import queue
+import time
+
+from . import db
+
+REVIEW_ACTIONS = ('right', 'correct', 'next_srs', 'easy',
+                  'wrong', 'incorrect', 'previous_srs',
+                  'bury', 'reset', 'mark', 'unmark')
+
+
+class CollectionPool:
+    """
+    Serve one srs-format file from several processes.
+
+    Read-only work (searching, deck stats, rendering) runs in a process pool, where every worker opens
+    the file read-only with a shared mmap. Reviews are funnelled through a single writer process,
+    which commits them in batches.
+
+    >>> with CollectionPool('collection.srs') as pool:
+    ...     card_ids = pool.find_cards('due:true').result()
+    ...     pool.review(card_ids[0], 'right').result()
+    """
+
+    poll_interval = 0.5   # seconds between checks that the writer process is still alive
+
+    def __init__(self, filename, processes=None, batch_size=100, batch_timeout=0.05,
+                 mmap_size=2 ** 28, mp_context=None):
+        """
+
+        :param str filename:
+        :param int|None processes: number of reader processes, defaults to the number of CPUs
+        :param int batch_size: maximum number of reviews committed in one transaction
+        :param float batch_timeout: seconds the writer waits for a batch to fill up
+        :param int mmap_size: bytes of the file memory-mapped by each reader
+        :param mp_context: multiprocessing context, defaults to 'spawn'
+        """
+        self.filename = str(Path(filename).resolve())
+
+        if mp_context is None:
+            mp_context = multiprocessing.get_context('spawn')
+
+        self._futures = dict()
+        self._futures_lock = threading.Lock()
+        self._job_id = 0
+        self._writer_error = None
+
+        self._write_queue = mp_context.Queue()
+        self._result_queue = mp_context.Queue()
+        self._writer = mp_context.Process(
+            target=_writer_main,
+            args=(self.filename, self._write_queue, self._result_queue, batch_size, batch_timeout),
+            daemon=True
+        )
+        self._writer.start()
+
+        # The writer creates the tables and switches the file to WAL, so readers must wait for it.
+        while True:
+            try:
+                ready = self._result_queue.get(timeout=self.poll_interval)
+                break
+            except queue.Empty:
+                if not self._writer.is_alive():
+                    raise RuntimeError('The writer process exited before it was ready')
+
+        if ready is not None:
+            self._writer.join()
+            raise ready
+
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+        self._readers = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=mp_context,
+            initializer=_reader_init,
+            initargs=(self.filename, mmap_size)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run a picklable, module-level function in a reader process.
+
+        :param fn:
+        :return Future:
+        """
+        return self._readers.submit(fn, *args, **kwargs)
+
+    def find_cards(self, q_str, fields=None, **kwargs):
+        return self.submit(_api_call, 'find_cards', q_str, fields, **kwargs)
+
+    def get_deck_dict(self, filter_=''):
+        return self.submit(_api_call, 'get_deck_dict', filter_)
+
+    def get_deck_stat(self, deck_name, filter_=''):
+        return self.submit(_api_call, 'get_deck_stat', deck_name, filter_)
+
+    def render_card(self, card_id):
+        return self.submit(render_card, card_id)
+
+    def review(self, card_id, action='right', **kwargs):
+        """
+        Queue a review for the writer process.
+
+        :param int card_id:
+        :param str action: name of a `db.Card` method, one of `REVIEW_ACTIONS`
+        :param kwargs: passed to the `db.Card` method
+        :return Future:
+        """
+        if action not in REVIEW_ACTIONS:
+            raise ValueError(action)
+
+        future = Future()
+        with self._futures_lock:
+            if self._writer_error:
+                future.set_exception(self._writer_error)
+                return future
+
+            self._job_id += 1
+            job_id = self._job_id
+            self._futures[job_id] = future
+
+        self._write_queue.put((job_id, card_id, action, kwargs))
+
+        return future
+
+    def close(self, timeout=10):
+        """
+
+        :param float timeout: seconds to wait for the writer to commit the queued reviews, before terminating it
+        :return:
+        """
+        self._readers.shutdown(wait=True)
+        self._write_queue.put(None)
+        self._writer.join(timeout)
+        if self._writer.is_alive():
+            self._writer.terminate()
+            self._writer.join()
+
+        self._collector.join()
+
+    def _collect(self):
+        while True:
+            try:
+                item = self._result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self._writer.is_alive():
+                    continue
+                item = None
+
+            if item is None:
+                self._fail_pending(RuntimeError('The writer process has exited'))
+                break
+
+            job_id, ok, value = item
+            with self._futures_lock:
+                future = self._futures.pop(job_id)
+
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _fail_pending(self, e):
+        with self._futures_lock:
+            self._writer_error = e
+            futures = list(self._futures.values())
+            self._futures.clear()
+
+        for future in futures:
+            future.set_exception(e)
+
+
+def _reader_init(filename, mmap_size):
+    db.database.init(Path(filename).as_uri() + '?mode=ro', uri=True, pragmas=(
+        ('mmap_size', mmap_size),
+        ('query_only', 1),
+    ))
+
+
+def _api_call(name, *args, **kwargs):
+    from . import api
+
+    return getattr(api, name)(*args, **kwargs)
+
+
+def render_card(card_id):
+    srs_card = db.Card.get(id=card_id)
+    return {
+        'id': srs_card.id,
+        'front': srs_card.front,
+        'back': srs_card.back
+    }
+
+
+def _picklable_error(e):
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError(repr(e))
+
+
+def _apply_batch(batch):
+    results = []
+
+    try:
+        with db.database.atomic():
+            for job_id, card_id, action, kwargs in batch:
+                try:
+                    with db.database.atomic():
+                        getattr(db.Card.get(id=card_id), action)(**kwargs)
+                    results.append((job_id, True, None))
+                except Exception as e:
+                    logging.error(e)
+                    results.append((job_id, False, _picklable_error(e)))
+    except Exception as e:
+        # The batch is rolled back as a whole, e.g. if the commit fails because the database is locked.
+        logging.error(e)
+        e = _picklable_error(e)
+        results = [(job_id, False, e) for job_id, _, _, _ in batch]
+
+    return results
+
+
+def _writer_main(filename, write_queue, result_queue, batch_size, batch_timeout):
+    from . import api
+
+    try:
+        api.init(filename, pragmas=(
+            ('journal_mode', 'wal'),
+        ))
+    except Exception as e:
+        result_queue.put(_picklable_error(e))
+        return
+
+    result_queue.put(None)
+
+    stop = False
+    while not stop:
+        item = write_queue.get()
+        if item is None:
+            break
+
+        batch = [item]
+        deadline = time.monotonic() + batch_timeout
+        while len(batch) < batch_size:
+            try:
+                item = write_queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+
+            if item is None:
+                stop = True
+                break
+
+            batch.append(item)
+
+        for result in _apply_batch(batch):
+            result_queue.put(result)
+
+    db.database.close()
+    result_queue.put(None)
@@ -0,0 +1,494 @@
+import peewee as pv
+
+from datetime import datetime
+from base64 import b64encode, b64decode
+import json
+import logging
+import dateutil.parser
+
+from . import db
+
+
+def current_seq():
+    """
+    :return int: the latest change sequence of this file, to be passed as `since` on the next sync
+    """
+    return db.Change.select(db.Change.id).order_by(db.Change.id.desc()).limit(1).scalar() or 0
+
+
+def export_changes(since=0, peer=None):
+    """
+    Stream the changes made after `since`, oldest first, as JSON-serializable dicts.
+
+    >>> with open('changes.jsonl', 'w') as f:
+    ...     f.writelines(json.dumps(c) + '\\n' for c in export_changes(since, peer='server'))
+
+    :param int since: change sequence of the last sync
+    :param str peer: leave out the changes that were applied from this peer, as it already has them
+    :return:
+    """
+    query = db.Change.select().where(db.Change.id > since).order_by(db.Change.id)
+    if peer is not None:
+        query = query.where(db.Change.origin.is_null(True) | (db.Change.origin != peer))
+
+    for change in query.iterator():
+        if change.op == 'upsert':
+            row = _DUMP[change.tbl](change.row_id)
+            if row is None:
+                continue
+        else:
+            row = None
+
+        yield {
+            'seq': change.id,
+            'table': change.tbl,
+            'op': change.op,
+            'id': change.row_id,
+            'key': json.loads(change.key),
+            'at': _dump_datetime(change.at),
+            'row': row
+        }
+
+
+def apply_changes(stream, peer, since=0):
+    """
+    Apply changes from `export_changes` of another file, in one transaction.
+
+    Notes and cards are resolved by last-writer-wins, on `modified` and `last_review` respectively,
+    which are both kept in UTC. Other rows are upserted, or deleted, as received. The changes are recorded
+    with `peer` as their origin, so that `export_changes(since, peer)` does not send them back.
+
+    :param stream: iterable of dicts, or of JSON lines, e.g. an opened file
+    :param str peer: name of the file the changes come from
+    :param int since: the latest `seq` received from `peer` so far
+    :return int: the latest `seq` received, to be passed as `since` on the next sync
+    """
+    last_seq = since
+    deferred = []
+    renamed = dict()    # (table, row id in the peer): deletes of the old keys of that row
+    kept = dict()       # table: ids of the local rows renamed or upserted, which later deletes must not remove
+
+    with db.database.atomic():
+        db.ChangeOrigin.delete().execute()
+        db.ChangeOrigin.create(peer=peer)
+
+        for change in stream:
+            if isinstance(change, (str, bytes)):
+                if not change.strip():
+                    continue
+                change = json.loads(change)
+
+            last_seq = max(last_seq, change['seq'])
+            if change['op'] == 'delete' and change.get('id') is not None:
+                # The key of a row was changed. The upsert of the same row renames the local row,
+                # so the delete is held back until the end, when it only removes rows that were not renamed.
+                renamed.setdefault((change['table'], change['id']), []).append(change)
+            elif not _apply_change(change, renamed, kept):
+                deferred.append(change)
+
+        # A row may arrive before the rows it refers to, because only the latest change of each row is kept.
+        while deferred:
+            remaining = [change for change in deferred if not _apply_change(change, renamed, kept)]
+            if len(remaining) == len(deferred):
+                for change in remaining:
+                    logging.error('Cannot apply change %s: %s is missing', change['seq'], change['key'])
+                break
+
+            deferred = remaining
+
+        for changes in renamed.values():
+            for change in changes:
+                _apply_change(change, renamed, kept)
+
+        db.ChangeOrigin.delete().execute()
+
+    return last_seq
+
+
+def _apply_change(change, renamed, kept):
+    """
+    :param dict change:
+    :param dict renamed:
+    :param dict kept:
+    :return bool: False, if a row that this change refers to does not exist yet
+    """
+    table = change['table']
+    kept_ids = kept.setdefault(table, set())
+    try:
+        if change['op'] == 'upsert':
+            if table in _REKEY:
+                for old_change in renamed.get((table, change.get('id')), []):
+                    kept_ids.add(_REKEY[table](old_change['key'], change['key']))
+
+            kept_ids.add(_UPSERT[table](change['key'], change['row']))
+        else:
+            _DELETE[table](change['key'], _parse_datetime(change['at']), kept_ids)
+    except _MissingRow:
+        return False
+
+    return True
+
+
+class _MissingRow(Exception):
+    pass
+
+
+def _dump_datetime(v):
+    if isinstance(v, datetime):
+        return v.isoformat()
+    return v
+
+
+def _parse_datetime(v):
+    if isinstance(v, str):
+        return dateutil.parser.parse(v)
+    return v
+
+
+def _update_if_changed(model, instance, row):
+    changed = {k: v for k, v in row.items() if getattr(instance, k) != v}
+    if changed:
+        model.update(**changed).where(model.id == instance.id).execute()
+
+
+def _without(row, *keys):
+    return {k: v for k, v in row.items() if k not in keys}
+
+
+def _rekey_column(field, old_value, value):
+    """
+    Rename the row whose natural key is `old_value`, unless another row has the new key already.
+    With NOCASE keys, a rename that only changes letter case finds the same row under both keys.
+
+    :return int|None: id of the renamed row
+    """
+    model = field.model
+    old_row = model.get_or_none(field == old_value)
+    if old_row:
+        new_row = model.get_or_none(field == value)
+        if new_row is None or new_row.id == old_row.id:
+            model.update({field: value}).where(model.id == old_row.id).execute()
+            return old_row.id
+
+
+def _note_constraint(note_id):
+    # `Note.constraint` reads back as key names only, so the JSON is fetched as is.
+    return json.loads(db.Note.select(pv.fn.json(db.Note.constraint).coerce(False))
+                      .where(db.Note.id == note_id).scalar())
+
+
+def _get_model(name):
+    srs_model = db.Model.get_or_none(name=name)
+    if srs_model is None:
+        raise _MissingRow
+    return srs_model
+
+
+def _get_template(model_name, name):
+    srs_template = db.Template.get_or_none(model=_get_model(model_name), name=name)
+    if srs_template is None:
+        raise _MissingRow
+    return srs_template
+
+
+def _get_note(constraint):
+    srs_note = db.Note.get_or_none(db.Note.constraint == constraint)
+    if srs_note is None:
+        raise _MissingRow
+    return srs_note
+
+
+def _get_card(front):
+    srs_card = db.Card.get_or_none(db.Card._front == front)
+    if srs_card is None:
+        raise _MissingRow
+    return srs_card
+
+
+def _dump_model(row_id):
+    srs_model = db.Model.get_or_none(id=row_id)
+    if srs_model:
+        return {
+            'name': srs_model.name,
+            'key_fields': srs_model.key_fields,
+            'css': srs_model.css,
+            'js': srs_model.js,
+            'info': srs_model.info
+        }
+
+
+def _upsert_model(key, row):
+    srs_model = db.Model.get_or_none(name=row['name'])
+    if srs_model is None:
+        return db.Model.insert(**row).execute()
+
+    _update_if_changed(db.Model, srs_model, row)
+    return srs_model.id
+
+
+def _rekey_model(old_key, key):
+    return _rekey_column(db.Model.name, old_key[0], key[0])
+
+
+def _delete_model(key, at, kept_ids):
+    srs_model = db.Model.get_or_none(name=key[0])
+    if srs_model and srs_model.id not in kept_ids:
+        if srs_model.templates.exists() or srs_model.notes.exists():
+            logging.error('Model %s is not deleted, as it is still in use', key[0])
+        else:
+            srs_model.delete_instance()
+
+
+def _dump_template(row_id):
+    srs_template = db.Template.get_or_none(id=row_id)
+    if srs_template:
+        return {
+            'model': srs_template.model.name,
+            'name': srs_template.name,
+            'front': srs_template.front,
+            'back': srs_template.back,
+            'info': srs_template.info
+        }
+
+
+def _upsert_template(key, row):
+    row = dict(_without(row, 'model'), model_id=_get_model(row['model']).id)
+    srs_template = db.Template.get_or_none(model=row['model_id'], name=row['name'])
+    if srs_template is None:
+        return db.Template.insert(**row).execute()
+
+    _update_if_changed(db.Template, srs_template, row)
+    return srs_template.id
+
+
+def _rekey_template(old_key, key):
+    new_model = _get_model(key[0])
+    old_template = db.Template.get_or_none(model=db.Model.get_or_none(name=old_key[0]), name=old_key[1])
+    if old_template:
+        new_template = db.Template.get_or_none(model=new_model, name=key[1])
+        if new_template is None or new_template.id == old_template.id:
+            db.Template.update(model=new_model, name=key[1]).where(db.Template.id == old_template.id).execute()
+            return old_template.id
+
+
+def _delete_template(key, at, kept_ids):
+    srs_template = db.Template.get_or_none(model=db.Model.get_or_none(name=key[0]), name=key[1])
+    if srs_template and srs_template.id not in kept_ids:
+        if srs_template.cards.exists():
+            logging.error('Template %s is not deleted, as it is still in use', key)
+        else:
+            srs_template.delete_instance()
+
+
+def _dump_tag(row_id):
+    srs_tag = db.Tag.get_or_none(id=row_id)
+    if srs_tag:
+        return {
+            'name': srs_tag.name
+        }
+
+
+def _upsert_tag(key, row):
+    return db.Tag.get_or_create(name=row['name'])[0].id
+
+
+def _rekey_tag(old_key, key):
+    return _rekey_column(db.Tag.name, old_key[0], key[0])
+
+
+def _delete_tag(key, at, kept_ids):
+    srs_tag = db.Tag.get_or_none(name=key[0])
+    if srs_tag and srs_tag.id not in kept_ids:
+        db.NoteTag.delete().where(db.NoteTag.tag == srs_tag).execute()
+        srs_tag.delete_instance()
+
+
+def _dump_deck(row_id):
+    srs_deck = db.Deck.get_or_none(id=row_id)
+    if srs_deck:
+        return {
+            'name': srs_deck.name,
+            'info': srs_deck.info
+        }
+
+
+def _upsert_deck(key, row):
+    srs_deck, created = db.Deck.get_or_create(name=row['name'], defaults={'info': row['info']})
+    if not created:
+        _update_if_changed(db.Deck, srs_deck, row)
+
+    return srs_deck.id
+
+
+def _rekey_deck(old_key, key):
+    old_deck = db.Deck.get_or_none(name=old_key[0])
+    if old_deck:
+        new_deck = db.Deck.get_or_none(name=key[0])
+        if new_deck is None or new_deck.id == old_deck.id:
+            old_deck.rename(key[0])
+            return old_deck.id
+
+
+def _delete_deck(key, at, kept_ids):
+    srs_deck = db.Deck.get_or_none(name=key[0])
+    if srs_deck and srs_deck.id not in kept_ids:
+        if srs_deck.has_sub_deck():
+            logging.error('Deck %s is not deleted, as it has sub-decks', key[0])
+        else:
+            srs_deck.delete_instance()
+
+
+def _dump_media(row_id):
+    srs_media = db.Media.get_or_none(id=row_id)
+    if srs_media:
+        return {
+            'data': b64encode(srs_media.data).decode(),
+            'h': srs_media.h,
+            'info': srs_media.info
+        }
+
+
+def _upsert_media(key, row):
+    srs_media = db.Media.get_or_none(h=row['h'])
+    if srs_media is None:
+        return db.Media.insert(data=b64decode(row['data']), h=row['h'], info=row['info']).execute()
+
+    _update_if_changed(db.Media, srs_media, {'info': row['info']})
+    return srs_media.id
+
+
+def _delete_media(key, at, kept_ids):
+    db.Media.delete().where((db.Media.h == key[0]) & db.Media.id.not_in(kept_ids)).execute()
+
+
+def _dump_note(row_id):
+    srs_note = db.Note.get_or_none(id=row_id)
+    if srs_note:
+        return {
+            'model': srs_note.model.name,
+            'data': srs_note.data,
+            'constraint': _note_constraint(srs_note.id),
+            'created': _dump_datetime(srs_note.created),
+            'modified': _dump_datetime(srs_note.modified),
+            'info': srs_note.info
+        }
+
+
+def _upsert_note(key, row):
+    # Notes are written with queries rather than save(), which would reset `modified` and create cards.
+    row = dict(_without(row, 'model'),
+               model_id=_get_model(row['model']).id,
+               created=_parse_datetime(row['created']),
+               modified=_parse_datetime(row['modified']))
+
+    srs_note = db.Note.get_or_none(db.Note.constraint == row['constraint'])
+    if srs_note is None:
+        return db.Note.insert(**row).execute()
+
+    if row['modified'] >= srs_note.modified:
+        _update_if_changed(db.Note, srs_note, _without(row, 'constraint'))
+    return srs_note.id
+
+
+def _rekey_note(old_key, key):
+    return _rekey_column(db.Note.constraint, old_key[0], key[0])
+
+
+def _delete_note(key, at, kept_ids):
+    srs_note = db.Note.get_or_none(db.Note.constraint == key[0])
+    if srs_note and srs_note.id not in kept_ids and at >= srs_note.modified:
+        db.NoteTag.delete().where(db.NoteTag.note == srs_note).execute()
+        srs_note.delete_instance()
+
+
+def _dump_card(row_id):
+    srs_card = db.Card.get_or_none(id=row_id)
+    if srs_card:
+        return {
+            'template': [srs_card.template.model.name, srs_card.template.name],
+            'note': _note_constraint(srs_card.note_id),
+            '_front': srs_card._front,
+            'srs_level': srs_card.srs_level,
+            'next_review': _dump_datetime(srs_card.next_review),
+            'last_review': _dump_datetime(srs_card.last_review),
+            'info': srs_card.info
+        }
+
+
+def _upsert_card(key, row):
+    row = dict(_without(row, 'template', 'note'),
+               template_id=_get_template(*row['template']).id,
+               note_id=_get_note(row['note']).id,
+               next_review=_parse_datetime(row['next_review']),
+               last_review=_parse_datetime(row['last_review']))
+
+    srs_card = db.Card.get_or_none(db.Card._front == row['_front'])
+    if srs_card is None:
+        return db.Card.insert(**row).execute()
+
+    if row['last_review'] >= srs_card.last_review:
+        _update_if_changed(db.Card, srs_card, row)
+    return srs_card.id
+
+
+def _rekey_card(old_key, key):
+    return _rekey_column(db.Card._front, old_key[0], key[0])
+
+
+def _delete_card(key, at, kept_ids):
+    srs_card = db.Card.get_or_none(db.Card._front == key[0])
+    if srs_card and srs_card.id not in kept_ids and at >= srs_card.last_review:
+        db.CardDeck.delete().where(db.CardDeck.card == srs_card).execute()
+        srs_card.delete_instance()
+
+
+def _dump_note_tag(row_id):
+    if db.NoteTag.select().where(db.NoteTag.id == row_id).exists():
+        return dict()
+
+
+def _upsert_note_tag(key, row):
+    srs_note = _get_note(key[0])
+    srs_tag = db.Tag.get_or_create(name=key[1])[0]
+    srs_note_tag = db.NoteTag.get_or_none(note=srs_note, tag=srs_tag)
+    if srs_note_tag is None:
+        return db.NoteTag.insert(note=srs_note, tag=srs_tag).execute()
+
+    return srs_note_tag.id
+
+
+def _delete_note_tag(key, at, kept_ids):
+    db.NoteTag.delete().where(
+        db.NoteTag.note.in_(db.Note.select(db.Note.id).where(db.Note.constraint == key[0]))
+        & db.NoteTag.tag.in_(db.Tag.select(db.Tag.id).where(db.Tag.name == key[1]))
+        & db.NoteTag.id.not_in(kept_ids)
+    ).execute()
+
+
+def _dump_card_deck(row_id):
+    if db.CardDeck.select().where(db.CardDeck.id == row_id).exists():
+        return dict()
+
+
+def _upsert_card_deck(key, row):
+    srs_card = _get_card(key[0])
+    srs_deck = db.Deck.get_or_create(name=key[1])[0]
+    srs_card_deck = db.CardDeck.get_or_none(card=srs_card, deck=srs_deck)
+    if srs_card_deck is None:
+        return db.CardDeck.insert(card=srs_card, deck=srs_deck).execute()
+
+    return srs_card_deck.id
+
+
+def _delete_card_deck(key, at, kept_ids):
+    db.CardDeck.delete().where(
+        db.CardDeck.card.in_(db.Card.select(db.Card.id).where(db.Card._front == key[0]))
+        & db.CardDeck.deck.in_(db.Deck.select(db.Deck.id).where(db.Deck.name == key[1]))
+        & db.CardDeck.id.not_in(kept_ids)
+    ).execute()
+
+
+_DUMP = {name: globals()[f'_dump_{name}'] for name in db.CHANGE_TRACKED}
+_UPSERT = {name: globals()[f'_upsert_{name}'] for name in db.CHANGE_TRACKED}
+_DELETE = {name: globals()[f'_delete_{name}'] for name in db.CHANGE_TRACKED}
+_REKEY = {name: globals()[f'_rekey_{name}'] for name in db.CHANGE_TRACKED if f'_rekey_{name}' in globals()}
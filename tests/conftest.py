@@ -0,0 +1,18 @@
+import pytest
+
+from srs_format import api, db
+
+
+@pytest.fixture
+def collection(tmp_path):
+    """A collection file with one model and 10 notes, each with one card."""
+    filename = str(tmp_path / 'collection.srs')
+
+    api.init(filename)
+    model_id = api.create_model('m', ['a'], [{'name': 't', 'front': '{{a}}'}])
+    for i in range(10):
+        api.create_note(model_id, {'a': f'x{i}'})
+
+    yield filename
+
+    db.database.close()
@@ -0,0 +1,42 @@
+import types
+
+from srs_format import api, db
+
+
+def test_find_model(collection):
+    model_id = db.Model.get(name='m').id
+    assert api.find_model('m') == api.find_model(model_id) == model_id
+    assert api.find_model('missing') is None
+    assert api.find_model(12345) is None
+
+
+def test_find_notes(collection):
+    note_ids = api.find_notes()
+    assert len(note_ids) == 10 and all(isinstance(note_id, int) for note_id in note_ids)
+
+    note_id = db.Note.get(db.Note.data['a'] == 'x3').id
+    assert api.find_notes({'a': 'x3'}) == [note_id]
+    assert api.find_notes({'a': 'x3'}, fields=['id', db.Note.data]) == [(note_id, {'a': 'x3'})]
+    assert api.find_notes({'a': 'missing'}) == []
+
+
+def test_iter_notes_and_cards_stream(collection):
+    assert isinstance(api.iter_notes(), types.GeneratorType)
+    assert isinstance(api.iter_cards(''), types.GeneratorType)
+    assert sorted(api.iter_notes()) == sorted(api.find_notes())
+
+
+def test_find_cards(collection):
+    card_ids = api.find_cards('')
+    assert card_ids == [c.id for c in db.Card.search('')]
+
+    card_id = db.Card.get(_front='x3').id
+    assert api.find_cards('a:x3') == [card_id]
+    assert api.find_cards('a:x3', fields=['id', '_front', db.Card.srs_level]) == [(card_id, 'x3', None)]
+    assert list(api.iter_cards('a:x3', fields=['_front'])) == [('x3',)]
+
+
+def test_search_fields(collection):
+    query = db.Card.search('a:x3', fields=['id'])
+    assert list(query.tuples()) == [(db.Card.get(_front='x3').id,)]
+    assert query.count() == 1
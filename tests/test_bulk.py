@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+from srs_format import api, db
+
+BASE = datetime(2030, 1, 1)
+
+
+def _next_reviews():
+    return dict(db.Card.select(db.Card.id, db.Card.next_review).tuples())
+
+
+def _schedule(card_ids, next_review):
+    db.Card.update(next_review=next_review, srs_level=3).where(db.Card.id.in_(card_ids)).execute()
+
+
+def test_reset(collection):
+    card_ids = sorted(_next_reviews())
+    _schedule(card_ids[:4], BASE)
+
+    assert api.cards_reset('', dry_run=True) == 10
+    assert _next_reviews()[card_ids[0]] == BASE
+
+    assert api.cards_reset('', chunk_size=3) == 10
+    assert set(db.Card.select(db.Card.srs_level, db.Card.next_review).tuples()) == {(None, None)}
+
+
+def test_bury_includes_cards_not_yet_due(collection):
+    card_ids = sorted(_next_reviews())
+    _schedule(card_ids[:4], BASE)
+
+    until = datetime(2040, 1, 1)
+    assert api.cards_bury('', until=until, chunk_size=3) == 10
+    assert set(_next_reviews().values()) == {until}
+
+
+def test_limit_and_offset(collection):
+    assert api.cards_bury('', dry_run=True, limit=5) == 5
+    assert api.cards_bury('', limit=5, chunk_size=2) == 5
+    assert api.cards_bury('', limit=5, offset=8, chunk_size=2) == 2
+    assert sum(v is not None for v in _next_reviews().values()) == 7
+
+
+def test_shift_due_spread(collection):
+    card_ids = sorted(_next_reviews())
+    _schedule(card_ids[:8], BASE)
+
+    delta = timedelta(days=3)
+    spread = timedelta(days=2)
+    assert api.cards_shift_due('', delta, dry_run=True) == 8
+    assert api.cards_shift_due('', delta, spread=spread, chunk_size=3) == 8
+
+    next_reviews = _next_reviews()
+    shifted = [next_reviews[card_id] for card_id in card_ids[:8]]
+    assert all(BASE + delta <= v < BASE + delta + spread for v in shifted)
+    assert len(set(shifted)) > 1
+    assert [next_reviews[card_id] for card_id in card_ids[8:]] == [None, None]
+
+
+def test_shift_due_back(collection):
+    card_ids = sorted(_next_reviews())
+    _schedule(card_ids[:1], BASE)
+
+    assert api.cards_shift_due('', timedelta(days=-1, hours=-6)) == 1
+    assert _next_reviews()[card_ids[0]] == datetime(2029, 12, 30, 18)
@@ -0,0 +1,62 @@
+import pytest
+
+from srs_format import api, db
+
+
+def _tree():
+    return sorted(db.Deck.select(db.Deck.name, db.Deck.parent, db.Deck.path, db.Deck.depth).tuples())
+
+
+def test_parents_are_created(collection):
+    card_ids = api.find_cards('')
+    api.cards_add_deck(card_ids[:2], 'A::B::C')
+
+    a, b, c = (db.Deck.get(name=name) for name in ('A', 'A::B', 'A::B::C'))
+    assert (a.parent, b.parent_id, c.parent_id) == (None, a.id, b.id)
+    assert c.path == f'/{a.id}/{b.id}/{c.id}/'
+    assert c.depth == 2
+
+    assert api.has_sub_deck('A') and not api.has_sub_deck('A::B::C')
+    assert sorted(api.find_cards('', deck='A')) == sorted(card_ids[:2])
+
+
+def test_rename_moves_subtree(collection):
+    card_ids = api.find_cards('')
+    api.cards_add_deck(card_ids[:2], 'A::B::C')
+    api.cards_add_deck(card_ids[2:3], 'Z')
+
+    api.rename_deck('A::B', 'Z::B')
+    assert [name for name, *_ in _tree()] == ['A', 'Z', 'Z::B', 'Z::B::C']
+    assert sorted(api.find_cards('', deck='Z')) == sorted(card_ids[:3])
+
+    api.move_deck('Z::B')
+    assert db.Deck.get(name='B::C').depth == 1
+
+    with pytest.raises(ValueError):
+        api.rename_deck('B', 'B::C::D')
+
+
+def test_rename_by_save(collection):
+    api.cards_add_deck(api.find_cards('')[:1], 'A::B')
+
+    srs_deck = db.Deck.get(name='A')
+    srs_deck.name = 'Q'
+    srs_deck.save()
+
+    srs_sub_deck = db.Deck.get(name='Q::B')
+    assert srs_sub_deck.path == f'/{srs_deck.id}/{srs_sub_deck.id}/'
+
+
+def test_delete_refuses_sub_decks(collection):
+    card_ids = api.find_cards('')
+    api.cards_add_deck(card_ids[:2], 'A::B::C')
+    api.cards_add_deck(card_ids[2:3], 'A::B')
+
+    with pytest.raises(ValueError):
+        db.Deck.get(name='A::B').delete_instance()
+    assert [name for name, *_ in _tree()] == ['A', 'A::B', 'A::B::C']
+
+    db.Deck.get(name='A::B::C').delete_instance()
+    db.Deck.get(name='A::B').delete_instance()
+    assert [name for name, *_ in _tree()] == ['A']
+    assert api.find_cards('', deck='A') == []
@@ -0,0 +1,56 @@
+import multiprocessing
+from concurrent.futures import Future
+import pytest
+
+import os
+
+from srs_format import api, db, pool as pool_module
+from srs_format.pool import CollectionPool
+
+
+@pytest.fixture
+def filename(collection):
+    api.cards_add_deck(api.find_cards('')[:3], 'A::B')
+    db.database.close()
+
+    return collection
+
+
+def test_read_and_review(filename):
+    with CollectionPool(filename, processes=2, mp_context=multiprocessing.get_context('spawn')) as pool:
+        card_ids = pool.find_cards('').result()
+        assert len(card_ids) == 10
+        assert pool.find_cards('', deck='A', fields=['id', 'srs_level']).result() == \
+            [(card_id, None) for card_id in sorted(card_ids)[:3]]
+        assert pool.get_deck_stat('A').result() == {'due': 0, 'remaining': 3}
+        assert pool.render_card(card_ids[0]).result()['front'].startswith('x')
+
+        assert [f.result() for f in [pool.review(card_id, 'right') for card_id in card_ids]] == [None] * 10
+        with pytest.raises(Exception):
+            pool.review(12345, 'bury').result()
+
+        assert pool.find_cards('due:false').result() == []
+
+
+def test_writer_exit_fails_pending_reviews(filename):
+    pool = CollectionPool(filename, processes=1, mp_context=multiprocessing.get_context('spawn'))
+    pool._writer.kill()
+    pool._writer.join()
+
+    future = pool.review(1, 'right')
+    assert isinstance(future, Future)
+    with pytest.raises(RuntimeError):
+        future.result(timeout=10)
+
+    pool.close(timeout=1)
+
+
+def _exit_writer(*args):
+    os._exit(1)
+
+
+def test_writer_exit_before_ready(filename, monkeypatch):
+    # With 'fork', the child runs the patched function of this process.
+    monkeypatch.setattr(pool_module, '_writer_main', _exit_writer)
+    with pytest.raises(RuntimeError):
+        CollectionPool(filename, processes=1, mp_context=multiprocessing.get_context('fork'))
@@ -0,0 +1,133 @@
+import json
+import time
+import pytest
+
+from srs_format import api, db, sync
+
+
+@pytest.fixture
+def peer(collection, tmp_path):
+    """A second, empty collection file. The collection file stays open."""
+    filename = str(tmp_path / 'peer.srs')
+    _use(filename)
+    _use(collection)
+
+    return filename
+
+
+def _use(filename):
+    db.database.close()
+    api.init(filename)
+
+
+def _sync(changes, filename, peer_name='collection'):
+    _use(filename)
+    return sync.apply_changes((json.dumps(change) for change in changes), peer_name)
+
+
+def test_first_sync_with_out_of_order_changes(collection, peer):
+    model = db.Model.get(name='m')
+    model.css = 'body {}'
+    model.save()
+
+    changes = list(sync.export_changes())
+    assert [change['table'] for change in changes][-1] == 'model'
+
+    assert _sync(changes, peer) == changes[-1]['seq']
+    assert db.Note.select().count() == db.Card.select().count() == 10
+    assert db.Model.get(name='m').css == 'body {}'
+
+
+def test_model_rename_keeps_references(collection, peer):
+    _sync(list(sync.export_changes()), peer)
+    _use(collection)
+    since = sync.current_seq()
+
+    db.Model.update(name='m2').execute()
+    db.Template.update(name='t2').execute()
+
+    _sync(list(sync.export_changes(since)), peer)
+    srs_model = db.Model.get()
+    assert srs_model.name == 'm2'
+    assert [t.name for t in db.Template.select()] == ['t2']
+    assert db.Note.select().where(db.Note.model != srs_model).count() == 0
+    assert db.Card.select().where(db.Card.template != db.Template.get()).count() == 0
+
+
+def test_deck_delete_keeps_local_sub_decks(collection, peer):
+    api.cards_add_deck(api.find_cards('')[:2], 'A')
+    api.cards_add_deck(api.find_cards('')[2:3], 'Z')
+    _sync(list(sync.export_changes()), peer)
+    api.cards_add_deck(api.find_cards('a:x0'), 'A::local')
+
+    _use(collection)
+    since = sync.current_seq()
+    db.Deck.get(name='A').delete_instance()
+    db.Deck.get(name='Z').delete_instance()
+
+    _sync(list(sync.export_changes(since)), peer)
+    assert [d.name for d in db.Deck.select().order_by(db.Deck.name)] == ['A', 'A::local']
+    assert api.get_deck_dict()['nodes'][0]['nodes'][0]['text'] == 'local'
+
+
+def test_case_only_rename(collection, peer):
+    card_ids = api.find_cards('')
+    api.cards_add_deck(card_ids[:2], 'deck')
+    api.notes_add_tag(api.find_notes()[:2], 'tg')
+    _sync(list(sync.export_changes()), peer)
+
+    _use(collection)
+    since = sync.current_seq()
+    api.rename_deck('deck', 'Deck')
+    db.Tag.update(name='TG').where(db.Tag.name == 'tg').execute()
+
+    _sync(list(sync.export_changes(since)), peer)
+    assert [d.name for d in db.Deck.select()] == ['Deck']
+    assert db.CardDeck.select().count() == 2
+    assert [t.name for t in db.Tag.select()] == ['TG']
+    assert db.NoteTag.select().count() == 2
+
+
+def test_stale_link_upserts_are_not_exported(collection):
+    api.cards_add_deck(api.find_cards('a:x0'), 'A::B')
+    api.rename_deck('A', 'Z')
+
+    keys = [change['key'] for change in sync.export_changes() if change['table'] == 'card_deck']
+    assert keys == [['x0', 'Z::B']]
+
+
+def test_last_writer_wins_across_timezones(collection, peer, monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        _sync(list(sync.export_changes()), peer)
+        since = sync.current_seq()
+        db.Card.get(_front='x0').delete_instance()
+
+        _sync(list(sync.export_changes(since, peer='collection')), collection, peer_name='peer')
+        assert not db.Card.select().where(db.Card._front == 'x0').exists()
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_review_and_no_echo(collection, peer):
+    _sync(list(sync.export_changes()), peer)
+    peer_since = sync.current_seq()
+
+    srs_card = db.Card.get(_front='x0')
+    srs_card.right()
+    back = list(sync.export_changes(peer_since, peer='collection'))
+    assert [(change['table'], change['key']) for change in back] == [('card', ['x0'])]
+
+    _use(collection)
+    since = sync.current_seq()
+    _sync(back, collection, peer_name='peer')
+    assert db.Card.get(_front='x0').srs_level == 0
+    assert sync.current_seq() > since
+    assert list(sync.export_changes(since, peer='peer')) == []
+    assert len(list(sync.export_changes(since, peer='other'))) == 1
+
+
+def test_empty_stream_keeps_since(collection):
+    assert sync.apply_changes([], 'peer', since=5) == 5